@@ -1,25 +1,140 @@
 import sqlite3
 import os
-import json
+import io
+import csv
+import tempfile
+import time
 import secrets
+import hmac
 import asyncio
-import pytz
+import atexit
+import logging
+import logging.handlers
+import queue
+import signal
+import string
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from pathlib import Path
 from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo, available_timezones
+import aiosqlite
+import orjson
 from aiohttp import web
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, ChatMemberHandler, filters, ContextTypes
+from telegram import Update, MessageOriginUser, MessageOriginChannel
+from telegram.error import Forbidden
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, ChatMemberHandler, filters, ContextTypes
+
+logger = logging.getLogger("bot")
 
 # Database setup
 DB_FILE = "/var/lib/light_status/config.db"
+SCHEMA_VERSION = 1  # Bump whenever create_schema() changes
 os.makedirs(os.path.dirname(DB_FILE), exist_ok=True)
 
 # Configuration
 TIMEOUT_MINUTES = 5
 HTTP_PORT = 8080
+# Public HTTPS base URL (e.g. https://example.com); when set, Telegram pushes updates
+# to WEBHOOK_PATH on the HTTP server instead of the bot long-polling getUpdates
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = "/telegram"
+HISTORY_RETENTION_DAYS = 90
+FLUSH_INTERVAL = 0.2  # Seconds between batched last_request_time and history writes
+DM_CONCURRENCY = 20  # Parallel DM sends when notifying subscribers
+SHUTDOWN_DRAIN_TIMEOUT = 10  # Seconds to wait for in-flight notifications on shutdown
+CHANNEL_NAME_TTL = 3600  # Seconds before a cached channel name is fetched again
+DASHBOARD_CACHE_TTL = 5  # Seconds a rendered dashboard page is served from memory
+DASHBOARD_CACHE_SIZE = 256  # Rendered dashboards kept, least recently viewed are dropped
+NAME_MAP_TTL = 30  # Seconds the /api/history channel name map is reused
+SUBSCRIBER_CACHE_TTL = 60  # Seconds a channel's DM subscriber list is reused
+EXPORT_SPOOL_BYTES = 1 << 20  # Exports bigger than this are spooled to disk
+EXPORT_BATCH_ROWS = 500  # History rows fetched and written per export batch
+COMPRESS_MIN_BYTES = 1024  # HTTP bodies smaller than this are sent uncompressed
+
+# Timezone names accepted by /set_timezone (computed once, the scan is slow)
+VALID_TIMEZONES = available_timezones()
+
+@lru_cache(maxsize=64)
+def get_tz(name):
+    """Return a cached ZoneInfo for the given timezone name"""
+    return ZoneInfo(name)
+
+def setup_logging():
+    """Log through a queue so handlers never wait on stdout, a listener thread does the writing"""
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+    # httpx logs every Telegram API request at INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    
+    listener.start()
+    atexit.register(listener.stop)
+
+# Shared connection, opened by init_db() and closed by close_db()
+db = None
+# Serializes multi-statement write transactions on the shared connection
+db_lock = asyncio.Lock()
+
+async def fetch_one(sql, params=()):
+    """Run a query on the shared connection and return its first row"""
+    async with db.execute(sql, params) as cur:
+        return await cur.fetchone()
+
+async def execute_write(sql, params=()):
+    """Run a single write under db_lock so it never lands inside another coroutine's transaction"""
+    async with db_lock:
+        return await db.execute(sql, params)
+
+@asynccontextmanager
+async def transaction():
+    """Run the enclosed writes as one transaction on the shared connection"""
+    async with db_lock:
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            await db.execute("ROLLBACK")
+            raise
+        try:
+            await db.execute("COMMIT")
+        except Exception:
+            # A failed COMMIT can leave the transaction open on the shared connection
+            if db.in_transaction:
+                await db.execute("ROLLBACK")
+            raise
+
+async def init_db():
+    """Open the shared connection and create or migrate the schema"""
+    global db
+    # Autocommit mode: single statements commit on their own, grouped writes
+    # go through transaction()
+    db = await aiosqlite.connect(DB_FILE, isolation_level=None)
+    # Let prune_history hand freed pages back to the OS. Switching an existing
+    # database needs a one-time VACUUM to rebuild the file.
+    if (await fetch_one("PRAGMA auto_vacuum"))[0] != 2:
+        await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        await db.execute("VACUUM")
+    # WAL lets readers run alongside the writer, NORMAL skips the fsync on every commit
+    await db.execute("PRAGMA journal_mode = WAL")
+    await db.execute("PRAGMA synchronous = NORMAL")
+    await db.execute("PRAGMA cache_size = -64000")
+    await db.execute("PRAGMA mmap_size = 268435456")
+    await db.execute("PRAGMA temp_store = MEMORY")
+    # Schema setup only runs when the file predates the current SCHEMA_VERSION
+    if (await fetch_one("PRAGMA user_version"))[0] != SCHEMA_VERSION:
+        await create_schema()
+        await db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
 
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("""
+async def create_schema():
+    """Create missing tables and indexes, adding columns older databases lack"""
+    await db.execute("""
         CREATE TABLE IF NOT EXISTS channels (
             channel_id INTEGER PRIMARY KEY,
             owner_id INTEGER,
@@ -29,10 +144,26 @@ def init_db():
             is_power_on INTEGER DEFAULT 0,
             last_status_change REAL,
             paused INTEGER DEFAULT 0,
-            channel_name TEXT
+            channel_name TEXT,
+            name_updated_at REAL,
+            today_uptime_sec REAL DEFAULT 0,
+            today_downtime_sec REAL DEFAULT 0,
+            today_outages INTEGER DEFAULT 0,
+            stats_epoch_start REAL
         )
     """)
-    conn.execute("""
+    # Add columns to databases created before they existed
+    columns = {row[1] for row in await db.execute_fetchall("PRAGMA table_info(channels)")}
+    for column, definition in (
+        ("name_updated_at", "REAL"),
+        ("today_uptime_sec", "REAL DEFAULT 0"),
+        ("today_downtime_sec", "REAL DEFAULT 0"),
+        ("today_outages", "INTEGER DEFAULT 0"),
+        ("stats_epoch_start", "REAL"),
+    ):
+        if column not in columns:
+            await db.execute(f"ALTER TABLE channels ADD COLUMN {column} {definition}")
+    await db.execute("""
         CREATE TABLE IF NOT EXISTS history (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             channel_id INTEGER,
@@ -41,7 +172,15 @@ def init_db():
             FOREIGN KEY (channel_id) REFERENCES channels(channel_id) ON DELETE CASCADE
         )
     """)
-    conn.execute("""
+    # check_timeouts() only ever looks at powered, unpaused channels
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_channels_active ON channels(last_request_time) "
+        "WHERE is_power_on = 1 AND paused = 0"
+    )
+    # Per-channel reads (/history, /export) and the global newest-first API feed / prune
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_history_channel_ts ON history(channel_id, timestamp)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_history_ts ON history(timestamp)")
+    await db.execute("""
         CREATE TABLE IF NOT EXISTS notifications (
             user_id INTEGER,
             channel_id INTEGER,
@@ -50,7 +189,16 @@ def init_db():
             FOREIGN KEY (channel_id) REFERENCES channels(channel_id) ON DELETE CASCADE
         )
     """)
-    conn.execute("""
+    # Subscriber lookups for DM fan-out go by channel
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_notifications_channel ON notifications(channel_id, enabled)")
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS usernames (
+            username TEXT PRIMARY KEY,
+            channel_id INTEGER,
+            FOREIGN KEY (channel_id) REFERENCES channels(channel_id) ON DELETE CASCADE
+        )
+    """)
+    await db.execute("""
         CREATE TABLE IF NOT EXISTS whitelist (
             channel_id INTEGER NOT NULL,
             user_id INTEGER NOT NULL,
@@ -60,14 +208,25 @@ def init_db():
             FOREIGN KEY (channel_id) REFERENCES channels(channel_id) ON DELETE CASCADE
         )
     """)
-    conn.commit()
-    conn.close()
-
-def get_channel_by_key(api_key):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.execute("SELECT channel_id, timezone, last_request_time, is_power_on, last_status_change FROM channels WHERE api_key = ?", (api_key,))
-    row = cur.fetchone()
-    conn.close()
+
+async def optimize_db():
+    """Let SQLite re-analyze tables whose statistics have drifted"""
+    await db.execute("PRAGMA optimize")
+
+async def close_db():
+    """Write buffered pings, refresh planner stats and close the shared connection"""
+    if db is None:
+        return
+    try:
+        await flush_pending_writes()
+        await optimize_db()
+    finally:
+        # Wait for a flush still in flight, then close even if the last one failed
+        async with db_lock:
+            await db.close()
+
+async def get_channel_by_key(api_key):
+    row = await fetch_one("SELECT channel_id, timezone, last_request_time, is_power_on, last_status_change FROM channels WHERE api_key = ?", (api_key,))
     if row:
         return {
             "channel_id": row[0],
@@ -78,30 +237,96 @@ def get_channel_by_key(api_key):
         }
     return None
 
+# api_key -> latest ping time not yet written, repeated pings from one device coalesce
+pending_pings = {}
+
+# (channel_id, status, timestamp) history rows not yet written
+pending_history = []
+
 def update_last_request(api_key, timestamp):
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("UPDATE channels SET last_request_time = ? WHERE api_key = ?", (timestamp, api_key))
-    conn.commit()
-    conn.close()
-
-def update_power_status(api_key, is_on, timestamp):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.execute("SELECT channel_id FROM channels WHERE api_key = ?", (api_key,))
-    row = cur.fetchone()
-    if row:
-        channel_id = row[0]
-        conn.execute("UPDATE channels SET is_power_on = ?, last_status_change = ? WHERE api_key = ?", 
-                     (1 if is_on else 0, timestamp, api_key))
-        conn.execute("INSERT INTO history (channel_id, status, timestamp) VALUES (?, ?, ?)",
-                     (channel_id, 1 if is_on else 0, timestamp))
-    conn.commit()
-    conn.close()
-
-def get_channel_config(channel_id):
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.execute("SELECT owner_id, api_key, timezone, last_request_time, is_power_on, last_status_change FROM channels WHERE channel_id = ?", (channel_id,))
-    row = cur.fetchone()
-    conn.close()
+    """Buffer a ping time, pending_writer() writes it out shortly after"""
+    pending_pings[api_key] = timestamp
+
+async def flush_pending_writes():
+    """Write all buffered ping times and history rows in one transaction"""
+    if not pending_pings and not pending_history:
+        return
+    # Entries stay buffered until COMMIT, so update_power_status still sees
+    # pings that are on their way to the table, and a failed batch is retried
+    async with transaction():
+        batch = [(timestamp, api_key) for api_key, timestamp in pending_pings.items()]
+        history = pending_history[:]
+        if batch:
+            await db.executemany("UPDATE channels SET last_request_time = ? WHERE api_key = ?", batch)
+        if history:
+            await db.executemany("INSERT INTO history (channel_id, status, timestamp) VALUES (?, ?, ?)", history)
+    # Keep pings that a newer one replaced meanwhile, new history rows only ever get appended
+    for timestamp, api_key in batch:
+        if pending_pings.get(api_key) == timestamp:
+            del pending_pings[api_key]
+    del pending_history[:len(history)]
+
+async def pending_writer():
+    """Background task to flush buffered writes every FLUSH_INTERVAL seconds"""
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        try:
+            # Shielded so shutdown never cancels a batch between COMMIT and dropping what it wrote
+            await asyncio.shield(flush_pending_writes())
+        except Exception:
+            # The batch stays buffered, keep flushing instead of losing every later ping
+            logger.exception("Failed to flush buffered writes")
+
+def get_day_start(tz, timestamp):
+    """Timestamp of local midnight for the day containing timestamp"""
+    dt = datetime.fromtimestamp(timestamp, tz)
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+
+async def update_power_status(api_key, is_on, timestamp, timezone, last_request_time=None):
+    """Record a status change and fold the finished period into today's totals.
+    Returns False if the channel was already in that state, so callers announce each change once.
+    With last_request_time set the change only applies if no ping arrived since that time."""
+    day_start = get_day_start(get_tz(timezone), timestamp)
+    # Under db_lock so the UPDATE cannot end up inside a batched flush's transaction
+    async with transaction():
+        # A ping buffered or mid-flush has not reached last_request_time yet
+        if last_request_time is not None and api_key in pending_pings:
+            return False
+        # Right-hand sides see the row before the update. When stats_epoch_start
+        # is not this day's midnight the counters belong to an earlier day and
+        # start over; a day that began with power off counts as one outage.
+        row = await fetch_one("""
+            UPDATE channels SET
+                today_uptime_sec = CASE WHEN stats_epoch_start = :day THEN today_uptime_sec ELSE 0 END
+                    + CASE WHEN is_power_on = 1 AND last_status_change IS NOT NULL
+                           THEN MAX(0, :ts - MAX(last_status_change, :day)) ELSE 0 END,
+                today_downtime_sec = CASE WHEN stats_epoch_start = :day THEN today_downtime_sec ELSE 0 END
+                    + CASE WHEN is_power_on = 0 AND last_status_change IS NOT NULL
+                           THEN MAX(0, :ts - MAX(last_status_change, :day)) ELSE 0 END,
+                today_outages = CASE WHEN stats_epoch_start = :day THEN today_outages
+                                     WHEN is_power_on = 0 AND last_status_change IS NOT NULL THEN 1
+                                     ELSE 0 END
+                    + CASE WHEN :on = 0 AND is_power_on = 1 THEN 1 ELSE 0 END,
+                stats_epoch_start = :day,
+                is_power_on = :on,
+                last_status_change = :ts,
+                -- The ping that turns power on counts as a request right away, not only once it is flushed
+                last_request_time = CASE WHEN :on = 1 THEN :ts ELSE last_request_time END
+            WHERE api_key = :key AND is_power_on IS NOT :on
+              AND (:last_req IS NULL OR last_request_time = :last_req)
+            RETURNING channel_id
+        """, {"on": 1 if is_on else 0, "ts": timestamp, "day": day_start, "key": api_key,
+              "last_req": last_request_time})
+        if not row:
+            return False
+    # The history row goes out with the next batched flush
+    pending_history.append((row[0], 1 if is_on else 0, timestamp))
+    # The cached dashboard still shows the old status
+    invalidate_dashboard(row[0])
+    return True
+
+async def get_channel_config(channel_id):
+    row = await fetch_one("SELECT owner_id, api_key, timezone, last_request_time, is_power_on, last_status_change FROM channels WHERE channel_id = ?", (channel_id,))
     if row:
         return {
             "owner_id": row[0],
@@ -113,32 +338,125 @@ def get_channel_config(channel_id):
         }
     return {"owner_id": None, "api_key": None, "timezone": "Europe/Kiev", "last_request_time": None, "is_power_on": False, "last_status_change": None}
 
-def create_channel(channel_id, owner_id):
+async def create_channel(channel_id, owner_id):
+    """Create channel with a fresh API key, returns None if channel already exists"""
     api_key = secrets.token_urlsafe(16)
-    conn = sqlite3.connect(DB_FILE)
-    try:
-        conn.execute("INSERT INTO channels (channel_id, owner_id, api_key) VALUES (?, ?, ?)", 
-                     (channel_id, owner_id, api_key))
-        conn.commit()
-        return api_key
-    except sqlite3.IntegrityError:
-        return None
-    finally:
-        conn.close()
+    async with db_lock:
+        row = await fetch_one(
+            "INSERT INTO channels (channel_id, owner_id, api_key) VALUES (?, ?, ?) "
+            "ON CONFLICT(channel_id) DO NOTHING RETURNING api_key",
+            (channel_id, owner_id, api_key)
+        )
+    return row[0] if row else None
 
-def is_owner(channel_id, user_id):
-    config = get_channel_config(channel_id)
+async def is_owner(channel_id, user_id):
+    config = await get_channel_config(channel_id)
     return config["owner_id"] is None or config["owner_id"] == user_id
 
+async def fetch_channel_with_owner_check(channel_id, user_id):
+    """Load channel config and check ownership with one query, returns (config, error reply)"""
+    config = await get_channel_config(channel_id)
+    if config["owner_id"] is not None and config["owner_id"] != user_id:
+        return config, "❌ Ви не є власником цього каналу"
+    if config["owner_id"] is None:
+        return config, "❌ Канал не налаштований"
+    return config, None
+
+# username (lowercase, without @) -> channel_id, backed by the usernames table
+_username_cache = {}
+
+async def lookup_username(username):
+    """Return cached channel_id for a username, or None if it was never resolved"""
+    username = username.lstrip('@').lower()
+    channel_id = _username_cache.get(username)
+    if channel_id is None:
+        row = await fetch_one("SELECT channel_id FROM usernames WHERE username = ?", (username,))
+        if row:
+            channel_id = _username_cache[username] = row[0]
+    return channel_id
+
+async def remember_username(username, channel_id):
+    """Save username -> channel_id mapping so later lookups skip get_chat.
+    A channel has one public username, so its previous mappings are dropped."""
+    username = username.lstrip('@').lower()
+    if _username_cache.get(username) == channel_id:
+        return
+    for old in [u for u, cid in _username_cache.items() if cid == channel_id]:
+        del _username_cache[old]
+    _username_cache[username] = channel_id
+    async with transaction():
+        await db.execute("DELETE FROM usernames WHERE channel_id = ? AND username != ?", (channel_id, username))
+        await db.execute("INSERT OR REPLACE INTO usernames (username, channel_id) VALUES (?, ?)", (username, channel_id))
+
+async def forget_usernames(channel_id):
+    """Drop all username mappings pointing to a channel"""
+    for username in [u for u, cid in _username_cache.items() if cid == channel_id]:
+        del _username_cache[username]
+    await execute_write("DELETE FROM usernames WHERE channel_id = ?", (channel_id,))
+
+# channel_id -> (expires_at, user_ids with DM notifications enabled)
+_subscriber_cache = {}
+SUBSCRIBERS_SQL = "SELECT user_id FROM notifications WHERE channel_id = ? AND enabled = 1"
+
+async def get_subscribers(channel_id):
+    """Return user IDs subscribed to a channel's DM notifications"""
+    cached = _subscriber_cache.get(channel_id)
+    if cached and time.monotonic() < cached[0]:
+        return cached[1]
+    rows = await db.execute_fetchall(SUBSCRIBERS_SQL, (channel_id,))
+    user_ids = [user_id for (user_id,) in rows]
+    _subscriber_cache[channel_id] = (time.monotonic() + SUBSCRIBER_CACHE_TTL, user_ids)
+    return user_ids
+
+async def prime_subscribers(channel_ids):
+    """Load subscriber lists for several channels with one query, ahead of a burst of notifications"""
+    now = time.monotonic()
+    missing = [cid for cid in set(channel_ids)
+               if cid not in _subscriber_cache or now >= _subscriber_cache[cid][0]]
+    if not missing:
+        return
+    rows = await db.execute_fetchall(
+        "SELECT channel_id, user_id FROM notifications "
+        f"WHERE enabled = 1 AND channel_id IN ({', '.join('?' * len(missing))})",
+        missing
+    )
+    subs_by_channel = {cid: [] for cid in missing}
+    for channel_id, user_id in rows:
+        subs_by_channel[channel_id].append(user_id)
+    expires_at = now + SUBSCRIBER_CACHE_TTL
+    for channel_id, user_ids in subs_by_channel.items():
+        _subscriber_cache[channel_id] = (expires_at, user_ids)
+
+async def set_notification(user_id, channel_id, enabled):
+    """Turn DM notifications for a channel on or off for a user"""
+    await execute_write("INSERT OR REPLACE INTO notifications (user_id, channel_id, enabled) VALUES (?, ?, ?)",
+                        (user_id, channel_id, enabled))
+    _subscriber_cache.pop(channel_id, None)
+
+async def disable_notifications(channel_id, user_ids):
+    """Turn off DM notifications for users who can no longer receive them"""
+    async with transaction():
+        await db.executemany(
+            "UPDATE notifications SET enabled = 0 WHERE user_id = ? AND channel_id = ?",
+            [(user_id, channel_id) for user_id in user_ids]
+        )
+    _subscriber_cache.pop(channel_id, None)
+
 async def resolve_channel_id(context: ContextTypes.DEFAULT_TYPE, channel_input: str):
     """Resolve channel username or ID to numeric channel_id"""
     if channel_input.startswith('@'):
-        # Try to get chat info by username
+        channel_id = await lookup_username(channel_input)
+        if channel_id is not None:
+            return channel_id
+        # Not seen before, try to get chat info by username
         try:
             chat = await context.bot.get_chat(channel_input)
-            return chat.id
         except Exception:
             return None
+        # Only configured channels get a mapping, anyone can make us resolve arbitrary names
+        if (await get_channel_config(chat.id))["owner_id"] is not None:
+            await remember_username(channel_input, chat.id)
+        return chat.id
     else:
         # Already numeric ID
         try:
@@ -146,90 +464,71 @@ async def resolve_channel_id(context: ContextTypes.DEFAULT_TYPE, channel_input:
         except ValueError:
             return None
 
-def update_channel_name(channel_id, channel_name):
+async def update_channel_name(channel_id, channel_name):
     """Update channel name in database"""
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("UPDATE channels SET channel_name = ? WHERE channel_id = ?", (channel_name, channel_id))
-    conn.commit()
-    conn.close()
-
-def set_timezone(channel_id, tz):
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("UPDATE channels SET timezone = ? WHERE channel_id = ?", (tz, channel_id))
-    conn.commit()
-    conn.close()
-
-def get_daily_stats(channel_id, timezone):
-    """Calculate today's uptime, downtime, and outage count"""
-    tz = pytz.timezone(timezone)
-    now = datetime.now(tz)
-    today_start = now.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
-    now_ts = now.timestamp()
-    
-    conn = sqlite3.connect(DB_FILE)
-    rows = conn.execute(
-        "SELECT status, timestamp FROM history WHERE channel_id = ? AND timestamp >= ? ORDER BY timestamp ASC",
-        (channel_id, today_start)
-    ).fetchall()
-    
-    # Get status at midnight (last event before today, or current status)
-    status_at_midnight = conn.execute(
-        "SELECT status FROM history WHERE channel_id = ? AND timestamp < ? ORDER BY timestamp DESC LIMIT 1",
-        (channel_id, today_start)
-    ).fetchone()
-    
-    # If no events today and no history before today, get current status
-    if not rows and not status_at_midnight:
-        cur = conn.execute("SELECT is_power_on, last_status_change FROM channels WHERE channel_id = ?", (channel_id,))
-        channel = cur.fetchone()
-        conn.close()
-        
-        if not channel or channel[1] is None:
-            return None
-        
-        # Calculate time from midnight to now in current status
-        duration = now_ts - today_start
-        if channel[0] == 1:  # is_power_on
-            return {"uptime": duration, "downtime": 0, "outages": 0}
+    await execute_write("UPDATE channels SET channel_name = ?, name_updated_at = ? WHERE channel_id = ?",
+                        (channel_name, time.time(), channel_id))
+    if channel_name.startswith('@'):
+        await remember_username(channel_name, channel_id)
+
+async def get_channel_names(bot, channels):
+    """Map channel_id to display name for (channel_id, channel_name, name_updated_at) rows.
+    Names older than CHANNEL_NAME_TTL are refreshed with concurrent get_chat calls."""
+    now = time.time()
+    names = {}
+    stale = []
+    for channel_id, channel_name, name_updated_at in channels:
+        if channel_name and name_updated_at and now - name_updated_at < CHANNEL_NAME_TTL:
+            names[channel_id] = channel_name
         else:
-            return {"uptime": 0, "downtime": duration, "outages": 0}
+            stale.append((channel_id, channel_name))
+    
+    chats = await asyncio.gather(*(bot.get_chat(channel_id) for channel_id, _ in stale), return_exceptions=True)
+    for (channel_id, channel_name), chat in zip(stale, chats):
+        if isinstance(chat, Exception):
+            names[channel_id] = channel_name or str(channel_id)
+            continue
+        if chat.username:
+            channel_name = f"@{chat.username}"
+        elif chat.title:
+            channel_name = chat.title
+        else:
+            channel_name = str(channel_id)
+        names[channel_id] = channel_name
+        await update_channel_name(channel_id, channel_name)
     
-    conn.close()
+    return names
+
+async def set_timezone(channel_id, tz):
+    await execute_write("UPDATE channels SET timezone = ? WHERE channel_id = ?", (tz, channel_id))
+
+async def get_daily_stats(channel_id, timezone):
+    """Calculate today's uptime, downtime, and outage count"""
+    tz = get_tz(timezone)
+    now_ts = datetime.now(tz).timestamp()
+    today_start = get_day_start(tz, now_ts)
     
-    uptime = 0
-    downtime = 0
-    outages = 0
+    row = await fetch_one(
+        "SELECT is_power_on, last_status_change, today_uptime_sec, today_downtime_sec, today_outages, stats_epoch_start "
+        "FROM channels WHERE channel_id = ?",
+        (channel_id,)
+    )
     
-    # Start from midnight with status at that time
-    if status_at_midnight:
-        prev_status = status_at_midnight[0]
-        # If day started with power OFF, count it as 1 outage
-        if prev_status == 0:
-            outages = 1
-    elif rows:
-        # No history before today, use first event's status
-        prev_status = rows[0][0]
-    else:
+    if not row or row[1] is None:
         return None
     
-    prev_time = today_start  # Start counting from midnight
+    is_on, last_change, uptime, downtime, outages, epoch = row
     
-    for status, timestamp in rows:
-        duration = timestamp - prev_time
-        if prev_status == 1:
-            uptime += duration
-        else:
-            downtime += duration
-        
-        if status == 0 and prev_status == 1:
-            outages += 1
-        
-        prev_status = status
-        prev_time = timestamp
+    if epoch != today_start:
+        # No status changes yet today, the whole day so far is in the current status
+        uptime = 0
+        downtime = 0
+        # If day started with power OFF, count it as 1 outage
+        outages = 0 if is_on else 1
     
-    # Add time from last event to now
-    duration = now_ts - prev_time
-    if prev_status == 1:
+    # Add time from last change (or midnight) to now
+    duration = now_ts - max(last_change, today_start)
+    if is_on:
         uptime += duration
     else:
         downtime += duration
@@ -240,6 +539,26 @@ def get_daily_stats(channel_id, timezone):
         "outages": outages
     }
 
+def local_time_formatter(tz, fmt):
+    """Return a timestamp -> local time string function that looks up the UTC offset once per day"""
+    cached_day = None
+    offset = 0
+    
+    def format_local(timestamp):
+        nonlocal cached_day, offset
+        day = int(timestamp // 86400)
+        if day != cached_day:
+            start = datetime.fromtimestamp(day * 86400, tz).utcoffset()
+            end = datetime.fromtimestamp(day * 86400 + 86399, tz).utcoffset()
+            if start != end:
+                # DST change within this day, resolve each timestamp on its own
+                return datetime.fromtimestamp(timestamp, tz).strftime(fmt)
+            cached_day = day
+            offset = start.total_seconds()
+        return time.strftime(fmt, time.gmtime(timestamp + offset))
+    
+    return format_local
+
 def format_duration(seconds):
     """Format duration in Ukrainian"""
     if seconds < 60:
@@ -265,33 +584,37 @@ def get_channel_id_from_arg(arg):
     except ValueError:
         return None
 
+START_HELP = (
+    "Команди:\n"
+    "/create_channel <channel_id|@username> - створити новий канал\n"
+    "/import_channel <channel_id|@username> <key> - імпортувати з ключем\n"
+    "/get_key <channel_id|@username> - отримати API ключ\n"
+    "/list_keys - показати всі канали та ключі\n"
+    "/set_timezone <channel_id|@username> <timezone> - встановити часовий пояс\n"
+    "/regenerate_key <channel_id|@username> - згенерувати новий ключ\n"
+    "/replace_key <channel_id|@username> <key> - замінити ключ\n"
+    "/remove_channel <channel_id|@username> - видалити канал\n"
+    "/transfer <channel_id|@username> <user_id> - передати власність\n"
+    "/history <channel_id|@username> [кількість] - історія змін\n"
+    "/notify <channel_id|@username> <on|off> - сповіщення в DM\n"
+    "/notify - показати налаштування сповіщень\n"
+    "/pause <channel_id|@username> <on|off> - призупинити/відновити\n"
+    "/stop <channel_id|@username> - зупинити моніторинг\n"
+    "/resume <channel_id|@username> - відновити моніторинг\n"
+    "/export <channel_id|@username> <csv|json> - експорт всієї історії\n"
+    "/status <channel_id|@username> - перевірити статус\n"
+    "/status - показати всі канали\n"
+    "/whitelist_add <channel_id|@username> <user_id> - додати до whitelist\n"
+    "/whitelist_remove <channel_id|@username> <user_id> - видалити з whitelist\n"
+    "/whitelist_list <channel_id|@username> - показати whitelist"
+)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
-    print(f"User {user.id} (@{user.username if user.username else 'no username'}) sent /start")
+    logger.info("User %s (@%s) sent /start", user.id, user.username or "no username")
     
     await update.message.reply_text(
-        "Команди:\n"
-        "/create_channel <channel_id|@username> - створити новий канал\n"
-        "/import_channel <channel_id|@username> <key> - імпортувати з ключем\n"
-        "/get_key <channel_id|@username> - отримати API ключ\n"
-        "/list_keys - показати всі канали та ключі\n"
-        "/set_timezone <channel_id|@username> <timezone> - встановити часовий пояс\n"
-        "/regenerate_key <channel_id|@username> - згенерувати новий ключ\n"
-        "/replace_key <channel_id|@username> <key> - замінити ключ\n"
-        "/remove_channel <channel_id|@username> - видалити канал\n"
-        "/transfer <channel_id|@username> <user_id> - передати власність\n"
-        "/history <channel_id|@username> [кількість] - історія змін\n"
-        "/notify <channel_id|@username> <on|off> - сповіщення в DM\n"
-        "/notify - показати налаштування сповіщень\n"
-        "/pause <channel_id|@username> <on|off> - призупинити/відновити\n"
-        "/stop <channel_id|@username> - зупинити моніторинг\n"
-        "/resume <channel_id|@username> - відновити моніторинг\n"
-        "/export <channel_id|@username> <csv|json> - експорт всієї історії\n"
-        "/status <channel_id|@username> - перевірити статус\n"
-        "/status - показати всі канали\n"
-        "/whitelist_add <channel_id|@username> <user_id> - додати до whitelist\n"
-        "/whitelist_remove <channel_id|@username> <user_id> - видалити з whitelist\n"
-        "/whitelist_list <channel_id|@username> - показати whitelist\n\n"
+        f"{START_HELP}\n\n"
         f"👤 Ваш Telegram ID: `{user.id}`\n\n"
         "Перешліть повідомлення з каналу для отримання ID."
     )
@@ -305,21 +628,17 @@ async def create_channel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE)
         channel_id = int(context.args[0])
         user_id = update.message.from_user.id
         
-        config = get_channel_config(channel_id)
-        if config["owner_id"] is not None:
+        api_key = await create_channel(channel_id, user_id)
+        if api_key is None:
             await update.message.reply_text("❌ Цей канал вже налаштований")
             return
         
-        api_key = create_channel(channel_id, user_id)
-        if api_key:
-            await update.message.reply_text(
-                f"✅ Канал створено!\n\n"
-                f"🔑 API ключ: `{api_key}`\n\n"
-                f"Використовуйте:\n"
-                f"`curl http://YOUR_SERVER:{HTTP_PORT}/channelPing?channel_key={api_key}`"
-            )
-        else:
-            await update.message.reply_text("❌ Помилка створення каналу")
+        await update.message.reply_text(
+            f"✅ Канал створено!\n\n"
+            f"🔑 API ключ: `{api_key}`\n\n"
+            f"Використовуйте:\n"
+            f"`curl http://YOUR_SERVER:{HTTP_PORT}/channelPing?channel_key={api_key}`"
+        )
     except ValueError:
         await update.message.reply_text("❌ Невірний ID каналу")
 
@@ -333,17 +652,15 @@ async def import_channel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE)
         api_key = context.args[1]
         user_id = update.message.from_user.id
         
-        config = get_channel_config(channel_id)
+        config = await get_channel_config(channel_id)
         if config["owner_id"] is not None:
             await update.message.reply_text("❌ Цей канал вже налаштований")
             return
         
         # Create channel with provided key
-        conn = sqlite3.connect(DB_FILE)
         try:
-            conn.execute("INSERT INTO channels (channel_id, owner_id, api_key) VALUES (?, ?, ?)", 
-                         (channel_id, user_id, api_key))
-            conn.commit()
+            await execute_write("INSERT INTO channels (channel_id, owner_id, api_key) VALUES (?, ?, ?)", 
+                                (channel_id, user_id, api_key))
             await update.message.reply_text(
                 f"✅ Канал імпортовано!\n\n"
                 f"🔑 API ключ: `{api_key}`\n\n"
@@ -352,8 +669,6 @@ async def import_channel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE)
             )
         except sqlite3.IntegrityError:
             await update.message.reply_text("❌ Цей ключ вже використовується")
-        finally:
-            conn.close()
     except ValueError:
         await update.message.reply_text("❌ Невірний ID каналу")
 
@@ -366,13 +681,9 @@ async def get_key_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         channel_id = int(context.args[0])
         user_id = update.message.from_user.id
         
-        if not is_owner(channel_id, user_id):
-            await update.message.reply_text("❌ Ви не є власником цього каналу")
-            return
-        
-        config = get_channel_config(channel_id)
-        if config["owner_id"] is None:
-            await update.message.reply_text("❌ Канал не налаштований")
+        config, error = await fetch_channel_with_owner_check(channel_id, user_id)
+        if error:
+            await update.message.reply_text(error)
             return
         
         await update.message.reply_text(
@@ -387,18 +698,16 @@ async def list_keys_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show all channels and their keys for the user"""
     user_id = update.message.from_user.id
     
-    conn = sqlite3.connect(DB_FILE)
-    channels = conn.execute(
+    channels = await db.execute_fetchall(
         "SELECT channel_id, api_key FROM channels WHERE owner_id = ? ORDER BY channel_id",
         (user_id,)
-    ).fetchall()
-    conn.close()
+    )
     
     if not channels:
         await update.message.reply_text("❌ У вас немає налаштованих каналів")
         return
     
-    msg = f"🔑 Ваші канали та ключі ({len(channels)}):\n\n"
+    parts = [f"🔑 Ваші канали та ключі ({len(channels)}):\n\n"]
     for channel_id, api_key in channels:
         # Try to get channel name
         try:
@@ -409,15 +718,15 @@ async def list_keys_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 channel_name = chat.title
             else:
                 channel_name = str(channel_id)
-            msg += f"📺 Канал: {channel_name} (`{channel_id}`)\n"
+            parts.append(f"📺 Канал: {channel_name} (`{channel_id}`)\n")
         except Exception:
-            msg += f"📺 Канал: `{channel_id}`\n"
+            parts.append(f"📺 Канал: `{channel_id}`\n")
         
-        msg += f"🔑 Ключ: `{api_key}`\n\n"
+        parts.append(f"🔑 Ключ: `{api_key}`\n\n")
     
-    msg += f"Використання:\n`curl http://YOUR_SERVER:{HTTP_PORT}/channelPing?channel_key=YOUR_KEY`"
+    parts.append(f"Використання:\n`curl http://YOUR_SERVER:{HTTP_PORT}/channelPing?channel_key=YOUR_KEY`")
     
-    await update.message.reply_text(msg)
+    await update.message.reply_text("".join(parts))
 
 async def set_timezone_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) < 2:
@@ -439,20 +748,16 @@ async def set_timezone_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     tz = context.args[1]
     user_id = update.message.from_user.id
     
-    if not is_owner(channel_id, user_id):
-        await update.message.reply_text("❌ Ви не є власником цього каналу")
+    config, error = await fetch_channel_with_owner_check(channel_id, user_id)
+    if error:
+        await update.message.reply_text(error)
         return
     
-    config = get_channel_config(channel_id)
-    if config["owner_id"] is None:
-        await update.message.reply_text("❌ Канал не налаштований")
-        return
-    
-    if tz not in pytz.all_timezones:
+    if tz not in VALID_TIMEZONES:
         await update.message.reply_text("❌ Невірний часовий пояс")
         return
     
-    set_timezone(channel_id, tz)
+    await set_timezone(channel_id, tz)
     await update.message.reply_text(f"✅ Часовий пояс встановлено: {tz}")
 
 async def regenerate_key_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -467,20 +772,13 @@ async def regenerate_key_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     user_id = update.message.from_user.id
     
-    if not is_owner(channel_id, user_id):
-        await update.message.reply_text("❌ Ви не є власником цього каналу")
-        return
-    
-    config = get_channel_config(channel_id)
-    if config["owner_id"] is None:
-        await update.message.reply_text("❌ Канал не налаштований")
+    config, error = await fetch_channel_with_owner_check(channel_id, user_id)
+    if error:
+        await update.message.reply_text(error)
         return
     
     new_key = secrets.token_urlsafe(32)
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("UPDATE channels SET api_key = ? WHERE channel_id = ?", (new_key, channel_id))
-    conn.commit()
-    conn.close()
+    await execute_write("UPDATE channels SET api_key = ? WHERE channel_id = ?", (new_key, channel_id))
     
     await update.message.reply_text(
         f"✅ Новий API ключ згенеровано!\n\n"
@@ -502,19 +800,12 @@ async def replace_key_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     new_key = context.args[1]
     user_id = update.message.from_user.id
     
-    if not is_owner(channel_id, user_id):
-        await update.message.reply_text("❌ Ви не є власником цього каналу")
+    config, error = await fetch_channel_with_owner_check(channel_id, user_id)
+    if error:
+        await update.message.reply_text(error)
         return
     
-    config = get_channel_config(channel_id)
-    if config["owner_id"] is None:
-        await update.message.reply_text("❌ Канал не налаштований")
-        return
-    
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("UPDATE channels SET api_key = ? WHERE channel_id = ?", (new_key, channel_id))
-    conn.commit()
-    conn.close()
+    await execute_write("UPDATE channels SET api_key = ? WHERE channel_id = ?", (new_key, channel_id))
     
     await update.message.reply_text(
         f"✅ API ключ замінено!\n\n"
@@ -534,19 +825,13 @@ async def remove_channel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     user_id = update.message.from_user.id
     
-    if not is_owner(channel_id, user_id):
-        await update.message.reply_text("❌ Ви не є власником цього каналу")
+    config, error = await fetch_channel_with_owner_check(channel_id, user_id)
+    if error:
+        await update.message.reply_text(error)
         return
     
-    config = get_channel_config(channel_id)
-    if config["owner_id"] is None:
-        await update.message.reply_text("❌ Канал не налаштований")
-        return
-    
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("DELETE FROM channels WHERE channel_id = ?", (channel_id,))
-    conn.commit()
-    conn.close()
+    await execute_write("DELETE FROM channels WHERE channel_id = ?", (channel_id,))
+    await forget_usernames(channel_id)
     
     await update.message.reply_text("✅ Канал видалено")
 
@@ -568,19 +853,12 @@ async def transfer_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     user_id = update.message.from_user.id
     
-    if not is_owner(channel_id, user_id):
-        await update.message.reply_text("❌ Ви не є власником цього каналу")
-        return
-    
-    config = get_channel_config(channel_id)
-    if config["owner_id"] is None:
-        await update.message.reply_text("❌ Канал не налаштований")
+    config, error = await fetch_channel_with_owner_check(channel_id, user_id)
+    if error:
+        await update.message.reply_text(error)
         return
     
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("UPDATE channels SET owner_id = ? WHERE channel_id = ?", (new_owner_id, channel_id))
-    conn.commit()
-    conn.close()
+    await execute_write("UPDATE channels SET owner_id = ? WHERE channel_id = ?", (new_owner_id, channel_id))
     
     await update.message.reply_text(f"✅ Власника каналу передано користувачу {new_owner_id}")
 
@@ -589,21 +867,39 @@ async def history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if not context.args:
         # Show history for all user's channels
-        conn = sqlite3.connect(DB_FILE)
-        channels = conn.execute(
+        channels = await db.execute_fetchall(
             "SELECT channel_id, channel_name, timezone FROM channels WHERE owner_id = ?",
             (user_id,)
-        ).fetchall()
+        )
         
         if not channels:
-            conn.close()
             await update.message.reply_text("❌ У вас немає налаштованих каналів")
             return
         
-        msg = "📜 Історія всіх каналів (останні події):\n\n"
+        # Last 10 events of every channel in one query
+        rows = await db.execute_fetchall("""
+            SELECT channel_id, status, timestamp FROM (
+                SELECT channel_id, status, timestamp,
+                       ROW_NUMBER() OVER (PARTITION BY channel_id ORDER BY timestamp DESC) AS rn
+                FROM history
+                WHERE channel_id IN (SELECT channel_id FROM channels WHERE owner_id = ?)
+            )
+            WHERE rn <= 10
+            ORDER BY channel_id, timestamp DESC
+        """, (user_id,))
+        
+        events = {}
+        for channel_id, status, timestamp in rows:
+            events.setdefault(channel_id, []).append((status, timestamp))
+        
+        parts = ["📜 Історія всіх каналів (останні події):\n\n"]
         
         for channel_id, channel_name, timezone in channels:
-            tz = pytz.timezone(timezone)
+            rows = events.get(channel_id)
+            if not rows:
+                continue
+            
+            tz = get_tz(timezone)
             
             # Get channel display name
             try:
@@ -617,22 +913,15 @@ async def history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             except Exception:
                 display_name = channel_name or str(channel_id)
             
-            rows = conn.execute(
-                "SELECT status, timestamp FROM history WHERE channel_id = ? ORDER BY timestamp DESC LIMIT 10",
-                (channel_id,)
-            ).fetchall()
-            
-            if rows:
-                msg += f"📍 {display_name}:\n"
-                for status, timestamp in rows:
-                    dt = datetime.fromtimestamp(timestamp, tz)
-                    status_emoji = "🟢" if status == 1 else "🔴"
-                    status_text = "з'явилося" if status == 1 else "зникло"
-                    msg += f"  {status_emoji} {dt.strftime('%d.%m %H:%M')} {status_text}\n"
-                msg += "\n"
+            parts.append(f"📍 {display_name}:\n")
+            for status, timestamp in rows:
+                dt = datetime.fromtimestamp(timestamp, tz)
+                status_emoji = "🟢" if status == 1 else "🔴"
+                status_text = "з'явилося" if status == 1 else "зникло"
+                parts.append(f"  {status_emoji} {dt.strftime('%d.%m %H:%M')} {status_text}\n")
+            parts.append("\n")
         
-        conn.close()
-        await update.message.reply_text(msg)
+        await update.message.reply_text("".join(parts))
         return
     
     channel_id = await resolve_channel_id(context, context.args[0])
@@ -646,28 +935,22 @@ async def history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Невірна кількість")
         return
     
-    if not is_owner(channel_id, user_id):
-        await update.message.reply_text("❌ Ви не є власником цього каналу")
+    config, error = await fetch_channel_with_owner_check(channel_id, user_id)
+    if error:
+        await update.message.reply_text(error)
         return
     
-    config = get_channel_config(channel_id)
-    if config["owner_id"] is None:
-        await update.message.reply_text("❌ Канал не налаштований")
-        return
-    
-    conn = sqlite3.connect(DB_FILE)
-    rows = conn.execute(
+    rows = await db.execute_fetchall(
         "SELECT status, timestamp FROM history WHERE channel_id = ? ORDER BY timestamp DESC LIMIT ?",
         (channel_id, limit)
-    ).fetchall()
-    conn.close()
+    )
     
     if not rows:
         await update.message.reply_text("📜 Історія порожня")
         return
     
-    tz = pytz.timezone(config["timezone"])
-    msg = f"📜 Історія (останні {len(rows)}):\n\n"
+    tz = get_tz(config["timezone"])
+    parts = [f"📜 Історія (останні {len(rows)}):\n\n"]
     
     prev_timestamp = None
     for status, timestamp in rows:
@@ -680,20 +963,18 @@ async def history_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             duration = prev_timestamp - timestamp
             duration_text = f" (тривало {format_duration(duration)})"
         
-        msg += f"{status_emoji} {dt.strftime('%d.%m %H:%M')} Світло {status_text}{duration_text}\n"
+        parts.append(f"{status_emoji} {dt.strftime('%d.%m %H:%M')} Світло {status_text}{duration_text}\n")
         prev_timestamp = timestamp
     
-    await update.message.reply_text(msg)
+    await update.message.reply_text("".join(parts))
 
 async def notify_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     
     if not context.args:
         # Show notification settings for all channels
-        conn = sqlite3.connect(DB_FILE)
-        channels = conn.execute("SELECT channel_id FROM channels WHERE owner_id = ?", (user_id,)).fetchall()
-        notifications = conn.execute("SELECT channel_id FROM notifications WHERE user_id = ? AND enabled = 1", (user_id,)).fetchall()
-        conn.close()
+        channels = await db.execute_fetchall("SELECT channel_id FROM channels WHERE owner_id = ?", (user_id,))
+        notifications = await db.execute_fetchall("SELECT channel_id FROM notifications WHERE user_id = ? AND enabled = 1", (user_id,))
         
         if not channels:
             await update.message.reply_text("❌ У вас немає налаштованих каналів")
@@ -723,21 +1004,13 @@ async def notify_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Використовуйте 'on' або 'off'")
         return
     
-    if not is_owner(channel_id, user_id):
-        await update.message.reply_text("❌ Ви не є власником цього каналу")
-        return
-    
-    config = get_channel_config(channel_id)
-    if config["owner_id"] is None:
-        await update.message.reply_text("❌ Канал не налаштований")
+    config, error = await fetch_channel_with_owner_check(channel_id, user_id)
+    if error:
+        await update.message.reply_text(error)
         return
     
     enabled = 1 if action == 'on' else 0
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("INSERT OR REPLACE INTO notifications (user_id, channel_id, enabled) VALUES (?, ?, ?)",
-                 (user_id, channel_id, enabled))
-    conn.commit()
-    conn.close()
+    await set_notification(user_id, channel_id, enabled)
     
     status_text = "увімкнено" if enabled else "вимкнено"
     await update.message.reply_text(f"✅ Сповіщення {status_text}")
@@ -763,20 +1036,13 @@ async def pause_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     user_id = update.message.from_user.id
     
-    if not is_owner(channel_id, user_id):
-        await update.message.reply_text("❌ Ви не є власником цього каналу")
-        return
-    
-    config = get_channel_config(channel_id)
-    if config["owner_id"] is None:
-        await update.message.reply_text("❌ Канал не налаштований")
+    config, error = await fetch_channel_with_owner_check(channel_id, user_id)
+    if error:
+        await update.message.reply_text(error)
         return
     
     paused = 1 if action == 'on' else 0
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("UPDATE channels SET paused = ? WHERE channel_id = ?", (paused, channel_id))
-    conn.commit()
-    conn.close()
+    await execute_write("UPDATE channels SET paused = ? WHERE channel_id = ?", (paused, channel_id))
     
     if paused:
         await update.message.reply_text("⏸️ Моніторинг призупинено. Бот не буде відстежувати зміни статусу.")
@@ -803,6 +1069,35 @@ async def resume_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.args.append('off')
     await pause_cmd(update, context)
 
+EXPORT_FIELDS = ("timestamp", "status", "datetime", "duration_minutes")
+
+async def iter_export_batches(channel_id, tz, is_power_on):
+    """Yield lists of (timestamp, status, datetime, duration_minutes) rows, the current period comes last"""
+    format_local = local_time_formatter(tz, '%Y-%m-%d %H:%M:%S')
+    prev_timestamp = None
+    # Minutes since the previous event come straight from SQLite via LAG()
+    async with db.execute(
+        """SELECT status, timestamp,
+                  COALESCE(CAST((timestamp - LAG(timestamp) OVER (ORDER BY timestamp)) / 60 AS INTEGER), 0)
+           FROM history WHERE channel_id = ? ORDER BY timestamp ASC""",
+        (channel_id,)
+    ) as cur:
+        while rows := await cur.fetchmany(EXPORT_BATCH_ROWS):
+            yield [
+                (int(timestamp), "on" if status == 1 else "off", format_local(timestamp), duration)
+                for status, timestamp, duration in rows
+            ]
+            prev_timestamp = rows[-1][1]
+    
+    if prev_timestamp is None:
+        return
+    
+    # Add current period
+    now = datetime.now(tz).timestamp()
+    duration = int((now - prev_timestamp) / 60)
+    current_status = "on" if is_power_on else "off"
+    yield [(int(now), current_status, format_local(now), duration)]
+
 async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) < 2:
         await update.message.reply_text("Використання: /export <channel_id|@username> <csv|json>")
@@ -820,95 +1115,48 @@ async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     user_id = update.message.from_user.id
     
-    if not is_owner(channel_id, user_id):
-        await update.message.reply_text("❌ Ви не є власником цього каналу")
-        return
-    
-    config = get_channel_config(channel_id)
-    if config["owner_id"] is None:
-        await update.message.reply_text("❌ Канал не налаштований")
-        return
-    
-    # Get all history
-    conn = sqlite3.connect(DB_FILE)
-    rows = conn.execute(
-        "SELECT status, timestamp FROM history WHERE channel_id = ? ORDER BY timestamp ASC",
-        (channel_id,)
-    ).fetchall()
-    conn.close()
-    
-    if not rows:
-        await update.message.reply_text("📜 Історія порожня")
-        return
-    
-    tz = pytz.timezone(config["timezone"])
-    
-    if format_type == 'csv':
-        import io
-        output = io.StringIO()
-        output.write("timestamp,status,datetime,duration_minutes\n")
-        
-        prev_timestamp = None
-        for status, timestamp in rows:
-            dt = datetime.fromtimestamp(timestamp, tz)
-            status_text = "on" if status == 1 else "off"
-            duration = int((timestamp - prev_timestamp) / 60) if prev_timestamp else 0
-            output.write(f"{int(timestamp)},{status_text},{dt.strftime('%Y-%m-%d %H:%M:%S')},{duration}\n")
-            prev_timestamp = timestamp
-        
-        # Add current period
-        now = datetime.now(tz).timestamp()
-        duration = int((now - prev_timestamp) / 60)
-        current_status = "on" if config["is_power_on"] else "off"
-        dt_now = datetime.fromtimestamp(now, tz)
-        output.write(f"{int(now)},{current_status},{dt_now.strftime('%Y-%m-%d %H:%M:%S')},{duration}\n")
-        
-        filename = f"channel_{channel_id}_export.csv"
-        await update.message.reply_document(
-            document=output.getvalue().encode('utf-8'),
-            filename=filename,
-            caption=f"📊 Експорт даних ({len(rows)+1} записів)"
-        )
-    else:  # json
-        import json
-        data = {
-            "channel_id": channel_id,
-            "timezone": config["timezone"],
-            "export_date": datetime.now(tz).isoformat(),
-            "total_events": len(rows) + 1,
-            "history": []
-        }
-        
-        prev_timestamp = None
-        for status, timestamp in rows:
-            dt = datetime.fromtimestamp(timestamp, tz)
-            status_text = "on" if status == 1 else "off"
-            duration = int((timestamp - prev_timestamp) / 60) if prev_timestamp else 0
-            data["history"].append({
-                "timestamp": int(timestamp),
-                "status": status_text,
-                "datetime": dt.strftime('%Y-%m-%d %H:%M:%S'),
-                "duration_minutes": duration
-            })
-            prev_timestamp = timestamp
+    config, error = await fetch_channel_with_owner_check(channel_id, user_id)
+    if error:
+        await update.message.reply_text(error)
+        return
+    
+    tz = get_tz(config["timezone"])
+    batches = iter_export_batches(channel_id, tz, config["is_power_on"])
+    
+    # Rows go straight from the cursor to a temp file that stays in memory
+    # until it outgrows EXPORT_SPOOL_BYTES
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES) as output:
+        count = 0
+        if format_type == 'csv':
+            text = io.TextIOWrapper(output, encoding='utf-8', newline='')
+            writer = csv.writer(text, lineterminator='\n')
+            writer.writerow(EXPORT_FIELDS)
+            async for batch in batches:
+                writer.writerows(batch)
+                count += len(batch)
+            text.detach()  # Flush and hand the file back without closing it
+        else:  # json
+            output.write(
+                f'{{\n  "channel_id": {channel_id},\n'
+                f'  "timezone": {orjson.dumps(config["timezone"]).decode()},\n'
+                f'  "export_date": "{datetime.now(tz).isoformat()}",\n'
+                f'  "history": ['.encode('utf-8')
+            )
+            async for batch in batches:
+                output.write(b",\n    " if count else b"\n    ")
+                output.write(b",\n    ".join(orjson.dumps(dict(zip(EXPORT_FIELDS, row))) for row in batch))
+                count += len(batch)
+            output.write(f'\n  ],\n  "total_events": {count}\n}}\n'.encode('utf-8'))
         
-        # Add current period
-        now = datetime.now(tz).timestamp()
-        duration = int((now - prev_timestamp) / 60)
-        current_status = "on" if config["is_power_on"] else "off"
-        dt_now = datetime.fromtimestamp(now, tz)
-        data["history"].append({
-            "timestamp": int(now),
-            "status": current_status,
-            "datetime": dt_now.strftime('%Y-%m-%d %H:%M:%S'),
-            "duration_minutes": duration
-        })
+        if not count:
+            await update.message.reply_text("📜 Історія порожня")
+            return
         
-        filename = f"channel_{channel_id}_export.json"
+        output.seek(0)
         await update.message.reply_document(
-            document=json.dumps(data, indent=2, ensure_ascii=False).encode('utf-8'),
-            filename=filename,
-            caption=f"📊 Експорт даних ({len(rows)+1} записів)"
+            document=output,
+            filename=f"channel_{channel_id}_export.{format_type}",
+            caption=f"📊 Експорт даних ({count} записів)"
         )
 
 async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -916,65 +1164,57 @@ async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if not context.args:
         # Show all channels
-        conn = sqlite3.connect(DB_FILE)
-        channels = conn.execute("SELECT channel_id, timezone FROM channels WHERE owner_id = ?", (user_id,)).fetchall()
-        conn.close()
+        channels = await db.execute_fetchall(
+            "SELECT channel_id, timezone, channel_name, name_updated_at, last_request_time, is_power_on "
+            "FROM channels WHERE owner_id = ?",
+            (user_id,)
+        )
         
         if not channels:
             await update.message.reply_text("❌ У вас немає налаштованих каналів")
             return
         
+        names = await get_channel_names(context.bot, [(row[0], row[2], row[3]) for row in channels])
+        
         online = []
         offline = []
         no_data = []
         
-        for channel_id, timezone in channels:
-            # Get channel name
-            try:
-                chat = await context.bot.get_chat(channel_id)
-                if chat.username:
-                    channel_name = f"@{chat.username}"
-                elif chat.title:
-                    channel_name = chat.title
-                else:
-                    channel_name = str(channel_id)
-            except Exception:
-                channel_name = str(channel_id)
-            
-            config = get_channel_config(channel_id)
-            if config["last_request_time"] is None:
+        for channel_id, timezone, _, _, last_request_time, is_power_on in channels:
+            channel_name = names[channel_id]
+            if last_request_time is None:
                 no_data.append((channel_name, channel_id, timezone))
             else:
-                tz = pytz.timezone(timezone)
+                tz = get_tz(timezone)
                 now = datetime.now(tz).timestamp()
-                time_since = now - config["last_request_time"]
-                if config["is_power_on"]:
+                time_since = now - last_request_time
+                if is_power_on:
                     online.append((channel_name, channel_id, timezone, time_since))
                 else:
                     offline.append((channel_name, channel_id, timezone, time_since))
         
-        msg = f"📊 Ваші канали ({len(channels)} всього)\n\n"
+        parts = [f"📊 Ваші канали ({len(channels)} всього)\n\n"]
         
         if online:
-            msg += f"🟢 Онлайн ({len(online)}):\n"
+            parts.append(f"🟢 Онлайн ({len(online)}):\n")
             for channel_name, channel_id, tz, time_since in online:
-                msg += f"  {channel_name} (`{channel_id}`)\n"
-                msg += f"  └ {format_duration(time_since)} тому • {tz}\n"
-            msg += "\n"
+                parts.append(f"  {channel_name} (`{channel_id}`)\n")
+                parts.append(f"  └ {format_duration(time_since)} тому • {tz}\n")
+            parts.append("\n")
         
         if offline:
-            msg += f"🔴 Офлайн ({len(offline)}):\n"
+            parts.append(f"🔴 Офлайн ({len(offline)}):\n")
             for channel_name, channel_id, tz, time_since in offline:
-                msg += f"  {channel_name} (`{channel_id}`)\n"
-                msg += f"  └ {format_duration(time_since)} тому • {tz}\n"
-            msg += "\n"
+                parts.append(f"  {channel_name} (`{channel_id}`)\n")
+                parts.append(f"  └ {format_duration(time_since)} тому • {tz}\n")
+            parts.append("\n")
         
         if no_data:
-            msg += f"⚠️ Немає даних ({len(no_data)}):\n"
+            parts.append(f"⚠️ Немає даних ({len(no_data)}):\n")
             for channel_name, channel_id, tz in no_data:
-                msg += f"  {channel_name} (`{channel_id}`) • {tz}\n"
+                parts.append(f"  {channel_name} (`{channel_id}`) • {tz}\n")
         
-        await update.message.reply_text(msg)
+        await update.message.reply_text("".join(parts))
         return
     
     channel_id = await resolve_channel_id(context, context.args[0])
@@ -982,20 +1222,16 @@ async def status_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Невірний ID або username каналу")
         return
     
-    if not is_owner(channel_id, user_id):
-        await update.message.reply_text("❌ Ви не є власником цього каналу")
-        return
-    
-    config = get_channel_config(channel_id)
-    if config["owner_id"] is None:
-        await update.message.reply_text("❌ Канал не налаштований")
+    config, error = await fetch_channel_with_owner_check(channel_id, user_id)
+    if error:
+        await update.message.reply_text(error)
         return
     
     if config["last_request_time"] is None:
         await update.message.reply_text("📊 Статус: 🔴 світла немає\n\n⚠️ Ще не було жодного запиту")
         return
     
-    tz = pytz.timezone(config["timezone"])
+    tz = get_tz(config["timezone"])
     now = datetime.now(tz).timestamp()
     last_req = config["last_request_time"]
     time_since = now - last_req
@@ -1024,7 +1260,7 @@ async def whitelist_add_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Невірний ID або username каналу")
         return
     
-    if not is_owner(channel_id, user_id):
+    if not await is_owner(channel_id, user_id):
         await update.message.reply_text("❌ Тільки власник може керувати whitelist")
         return
     
@@ -1038,18 +1274,15 @@ async def whitelist_add_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Ви вже є власником каналу")
         return
     
-    conn = sqlite3.connect(DB_FILE)
-    try:
-        conn.execute(
-            "INSERT INTO whitelist (channel_id, user_id, added_by) VALUES (?, ?, ?)",
-            (channel_id, target_user_id, user_id)
-        )
-        conn.commit()
+    cursor = await execute_write(
+        "INSERT OR IGNORE INTO whitelist (channel_id, user_id, added_by) VALUES (?, ?, ?)",
+        (channel_id, target_user_id, user_id)
+    )
+    
+    if cursor.rowcount > 0:
         await update.message.reply_text(f"✅ Користувач {target_user_id} додано до whitelist")
-    except sqlite3.IntegrityError:
+    else:
         await update.message.reply_text("❌ Користувач вже в whitelist")
-    finally:
-        conn.close()
 
 async def whitelist_remove_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) < 2:
@@ -1063,7 +1296,7 @@ async def whitelist_remove_cmd(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("❌ Невірний ID або username каналу")
         return
     
-    if not is_owner(channel_id, user_id):
+    if not await is_owner(channel_id, user_id):
         await update.message.reply_text("❌ Тільки власник може керувати whitelist")
         return
     
@@ -1073,18 +1306,15 @@ async def whitelist_remove_cmd(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("❌ Невірний user_id")
         return
     
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.execute(
+    cursor = await execute_write(
         "DELETE FROM whitelist WHERE channel_id = ? AND user_id = ?",
         (channel_id, target_user_id)
     )
-    conn.commit()
     
     if cursor.rowcount > 0:
         await update.message.reply_text(f"✅ Користувач {target_user_id} видалено з whitelist")
     else:
         await update.message.reply_text("❌ Користувач не знайдено в whitelist")
-    conn.close()
 
 async def whitelist_list_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
@@ -1098,16 +1328,14 @@ async def whitelist_list_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("❌ Невірний ID або username каналу")
         return
     
-    if not is_owner(channel_id, user_id):
+    if not await is_owner(channel_id, user_id):
         await update.message.reply_text("❌ Тільки власник може переглядати whitelist")
         return
     
-    conn = sqlite3.connect(DB_FILE)
-    rows = conn.execute(
+    rows = await db.execute_fetchall(
         "SELECT user_id, added_at FROM whitelist WHERE channel_id = ? ORDER BY added_at",
         (channel_id,)
-    ).fetchall()
-    conn.close()
+    )
     
     if not rows:
         await update.message.reply_text("📋 Whitelist порожній")
@@ -1124,39 +1352,21 @@ async def handle_forwarded(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not msg:
         return
     
-    # Debug: log what we receive
-    print(f"Forwarded message received. Has forward_origin: {hasattr(msg, 'forward_origin')}")
-    if hasattr(msg, 'forward_origin'):
-        print(f"Forward origin type: {type(msg.forward_origin)}")
-        print(f"Forward origin: {msg.forward_origin}")
-    
-    if hasattr(msg, 'forward_origin') and msg.forward_origin:
-        origin = msg.forward_origin
-        
-        # Check for SenderUser type (forwarded from user)
-        if hasattr(origin, 'sender_user') and origin.sender_user:
-            user = origin.sender_user
-            response = f"👤 User ID: `{user.id}`"
-            if user.username:
-                response += f"\nUsername: @{user.username}"
-            await msg.reply_text(response)
-            return
-        
-        # Check for channel
-        if hasattr(origin, 'chat') and origin.chat:
-            if origin.chat.type == "channel":
-                channel_id = origin.chat.id
-                await msg.reply_text(
-                    f"ID каналу: {channel_id}\n\n"
-                    f"Використайте: /create_channel {channel_id}"
-                )
-            elif origin.chat.type == "private":
-                user_id = origin.chat.id
-                username = origin.chat.username if hasattr(origin.chat, 'username') else None
-                response = f"👤 User ID: `{user_id}`"
-                if username:
-                    response += f"\nUsername: @{username}"
-                await msg.reply_text(response)
+    origin = msg.forward_origin
+    logger.debug("Forwarded message received, origin: %r", origin)
+    
+    if isinstance(origin, MessageOriginUser):
+        user = origin.sender_user
+        response = f"👤 User ID: `{user.id}`"
+        if user.username:
+            response += f"\nUsername: @{user.username}"
+        await msg.reply_text(response)
+    elif isinstance(origin, MessageOriginChannel):
+        channel_id = origin.chat.id
+        await msg.reply_text(
+            f"ID каналу: {channel_id}\n\n"
+            f"Використайте: /create_channel {channel_id}"
+        )
 
 async def handle_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle bot being added to channel"""
@@ -1172,11 +1382,13 @@ async def handle_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TY
     # Bot was added to channel
     if new_status in ["administrator", "member"]:
         channel_id = chat.id
-        config = get_channel_config(channel_id)
+        config = await get_channel_config(channel_id)
         
         # Only post if channel is configured
         if config["owner_id"] is not None:
-            tz = pytz.timezone(config["timezone"])
+            if chat.username:
+                await remember_username(chat.username, channel_id)
+            tz = get_tz(config["timezone"])
             now = datetime.now(tz)
             time_str = now.strftime("%H:%M")
             
@@ -1198,11 +1410,133 @@ async def handle_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TY
             
             try:
                 await context.bot.send_message(chat_id=channel_id, text=message)
-            except Exception as e:
-                print(f"Error sending initial status to {channel_id}: {e}")
+            except Exception:
+                logger.exception("Error sending initial status to %s", channel_id)
 
 # HTTP server for ping requests
 telegram_app = None
+# telegram_app.bot, bound once at startup
+tg_bot = None
+# Caps concurrent DM sends across all notifications, Telegram allows ~30 messages/s per bot
+dm_semaphore = asyncio.Semaphore(DM_CONCURRENCY)
+# Telegram echoes this in every webhook request, so forged updates can be rejected
+webhook_secret = secrets.token_urlsafe(32)
+# Rendered dashboards, least recently viewed first: channel_id -> (expires_at, html bytes),
+# plus renders in flight and a per-channel generation bumped on every status change
+_dash_cache = OrderedDict()
+_dash_renders = {}
+_dash_generation = {}
+
+def invalidate_dashboard(channel_id):
+    """Drop the cached page and detach any render that may still read the old status"""
+    _dash_cache.pop(channel_id, None)
+    _dash_renders.pop(channel_id, None)
+    _dash_generation[channel_id] = _dash_generation.get(channel_id, 0) + 1
+
+# Static page layout, only the $-slots are filled in per render
+DASHBOARD_TEMPLATE = string.Template("""
+<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>$channel_name - Power Status</title>
+    <style>
+        body {
+            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, Cantarell, sans-serif;
+            max-width: 800px;
+            margin: 0 auto;
+            padding: 20px;
+            background: #f5f5f5;
+        }
+        .card {
+            background: white;
+            border-radius: 8px;
+            padding: 20px;
+            margin-bottom: 20px;
+            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
+        }
+        h1 {
+            margin: 0 0 10px 0;
+            color: #333;
+        }
+        .status {
+            font-size: 48px;
+            font-weight: bold;
+            color: $status_color;
+            margin: 20px 0;
+        }
+        .info {
+            display: grid;
+            grid-template-columns: 1fr 1fr;
+            gap: 15px;
+            margin-top: 20px;
+        }
+        .info-item {
+            padding: 15px;
+            background: #f9f9f9;
+            border-radius: 4px;
+        }
+        .info-label {
+            font-size: 12px;
+            color: #666;
+            text-transform: uppercase;
+            margin-bottom: 5px;
+        }
+        .info-value {
+            font-size: 20px;
+            font-weight: bold;
+            color: #333;
+        }
+        .footer {
+            text-align: center;
+            color: #999;
+            font-size: 12px;
+            margin-top: 20px;
+        }
+        @media (max-width: 600px) {
+            .info {
+                grid-template-columns: 1fr;
+            }
+        }
+    </style>
+    <meta http-equiv="refresh" content="30">
+</head>
+<body>
+    <div class="card">
+        <h1>$channel_name</h1>
+        <div class="status">$status</div>
+        <div style="color: #666;">Last ping: $last_ping_str ($time_since_str ago)</div>
+    </div>
+    
+    <div class="card">
+        <h2 style="margin-top: 0;">Today's Statistics</h2>
+        <div class="info">
+            <div class="info-item">
+                <div class="info-label">Uptime</div>
+                <div class="info-value" style="color: #4CAF50;">$uptime_str</div>
+            </div>
+            <div class="info-item">
+                <div class="info-label">Downtime</div>
+                <div class="info-value" style="color: #f44336;">$downtime_str</div>
+            </div>
+            <div class="info-item">
+                <div class="info-label">Outages</div>
+                <div class="info-value">$outages</div>
+            </div>
+            <div class="info-item">
+                <div class="info-label">Timezone</div>
+                <div class="info-value" style="font-size: 16px;">$timezone</div>
+            </div>
+        </div>
+    </div>
+    
+    <div class="footer">
+        Auto-refreshes every 30 seconds • Powered by Light Status Bot
+    </div>
+</body>
+</html>
+""")
 
 async def handle_dashboard(request):
     """Simple public dashboard for a channel"""
@@ -1212,16 +1546,19 @@ async def handle_dashboard(request):
         return web.Response(text="Missing channel_id or username", status=400)
     
     # Try to resolve username or parse ID
-    if channel_input.startswith('@') or not channel_input.lstrip('-').isdigit():
+    is_username = channel_input.startswith('@') or not channel_input.lstrip('-').isdigit()
+    if is_username:
         # It's a username, resolve it
-        try:
-            if telegram_app:
-                chat = await telegram_app.bot.get_chat(channel_input if channel_input.startswith('@') else f"@{channel_input}")
-                channel_id = chat.id
-            else:
-                return web.Response(text="Bot not ready", status=503)
-        except Exception:
-            return web.Response(text="Channel not found", status=404)
+        channel_id = await lookup_username(channel_input)
+        if channel_id is None:
+            try:
+                if tg_bot:
+                    chat = await tg_bot.get_chat(channel_input if channel_input.startswith('@') else f"@{channel_input}")
+                    channel_id = chat.id
+                else:
+                    return web.Response(text="Bot not ready", status=503)
+            except Exception:
+                return web.Response(text="Channel not found", status=404)
     else:
         # It's a numeric ID
         try:
@@ -1229,12 +1566,48 @@ async def handle_dashboard(request):
         except ValueError:
             return web.Response(text="Invalid channel_id", status=400)
     
-    config = get_channel_config(channel_id)
-    if config["owner_id"] is None:
+    html = await get_dashboard_html(channel_id)
+    if html is None:
         return web.Response(text="Channel not found", status=404)
+    if is_username:
+        # Remembered only now that the channel is known to be configured, this route is public
+        await remember_username(channel_input, channel_id)
+    return web.Response(body=html, content_type='text/html')
+
+async def get_dashboard_html(channel_id):
+    """Return the rendered dashboard, reusing it for DASHBOARD_CACHE_TTL seconds.
+    Concurrent requests for the same channel share a single render."""
+    cached = _dash_cache.get(channel_id)
+    if cached and time.monotonic() < cached[0]:
+        _dash_cache.move_to_end(channel_id)
+        return cached[1]
+    
+    generation = _dash_generation.get(channel_id, 0)
+    render = _dash_renders.get(channel_id)
+    if render is None:
+        render = _dash_renders[channel_id] = asyncio.ensure_future(render_dashboard(channel_id))
+        def forget_render(task):
+            # A status change may already have replaced this render with a newer one
+            if _dash_renders.get(channel_id) is task:
+                del _dash_renders[channel_id]
+        render.add_done_callback(forget_render)
+    html = await asyncio.shield(render)
+    # A status change during the render means the page may be stale, serve it once but don't keep it
+    if html is not None and _dash_generation.get(channel_id, 0) == generation:
+        _dash_cache[channel_id] = (time.monotonic() + DASHBOARD_CACHE_TTL, html)
+        _dash_cache.move_to_end(channel_id)
+        if len(_dash_cache) > DASHBOARD_CACHE_SIZE:
+            _dash_cache.popitem(last=False)
+    return html
+
+async def render_dashboard(channel_id):
+    """Build the dashboard page, None if the channel is not configured"""
+    config = await get_channel_config(channel_id)
+    if config["owner_id"] is None:
+        return None
     
     # Get current status
-    tz = pytz.timezone(config["timezone"])
+    tz = get_tz(config["timezone"])
     now = datetime.now(tz)
     
     if config["last_request_time"]:
@@ -1250,7 +1623,7 @@ async def handle_dashboard(request):
     status_color = "#4CAF50" if config["is_power_on"] else "#f44336"
     
     # Get daily stats
-    stats = get_daily_stats(channel_id, config["timezone"])
+    stats = await get_daily_stats(channel_id, config["timezone"])
     if stats:
         uptime_str = format_duration(stats["uptime"])
         downtime_str = format_duration(stats["downtime"])
@@ -1262,8 +1635,8 @@ async def handle_dashboard(request):
     
     # Get channel name
     try:
-        if telegram_app:
-            chat = await telegram_app.bot.get_chat(channel_id)
+        if tg_bot:
+            chat = await tg_bot.get_chat(channel_id)
             if chat.username:
                 channel_name = f"@{chat.username}"
             elif chat.title:
@@ -1271,125 +1644,44 @@ async def handle_dashboard(request):
             else:
                 channel_name = f"Channel {channel_id}"
             # Save to database for Grafana
-            update_channel_name(channel_id, channel_name)
+            await update_channel_name(channel_id, channel_name)
         else:
             channel_name = f"Channel {channel_id}"
     except Exception:
         channel_name = f"Channel {channel_id}"
     
-    html = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>{channel_name} - Power Status</title>
-        <style>
-            body {{
-                font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, Oxygen, Ubuntu, Cantarell, sans-serif;
-                max-width: 800px;
-                margin: 0 auto;
-                padding: 20px;
-                background: #f5f5f5;
-            }}
-            .card {{
-                background: white;
-                border-radius: 8px;
-                padding: 20px;
-                margin-bottom: 20px;
-                box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-            }}
-            h1 {{
-                margin: 0 0 10px 0;
-                color: #333;
-            }}
-            .status {{
-                font-size: 48px;
-                font-weight: bold;
-                color: {status_color};
-                margin: 20px 0;
-            }}
-            .info {{
-                display: grid;
-                grid-template-columns: 1fr 1fr;
-                gap: 15px;
-                margin-top: 20px;
-            }}
-            .info-item {{
-                padding: 15px;
-                background: #f9f9f9;
-                border-radius: 4px;
-            }}
-            .info-label {{
-                font-size: 12px;
-                color: #666;
-                text-transform: uppercase;
-                margin-bottom: 5px;
-            }}
-            .info-value {{
-                font-size: 20px;
-                font-weight: bold;
-                color: #333;
-            }}
-            .footer {{
-                text-align: center;
-                color: #999;
-                font-size: 12px;
-                margin-top: 20px;
-            }}
-            @media (max-width: 600px) {{
-                .info {{
-                    grid-template-columns: 1fr;
-                }}
-            }}
-        </style>
-        <meta http-equiv="refresh" content="30">
-    </head>
-    <body>
-        <div class="card">
-            <h1>{channel_name}</h1>
-            <div class="status">{status}</div>
-            <div style="color: #666;">Last ping: {last_ping_str} ({time_since_str} ago)</div>
-        </div>
-        
-        <div class="card">
-            <h2 style="margin-top: 0;">Today's Statistics</h2>
-            <div class="info">
-                <div class="info-item">
-                    <div class="info-label">Uptime</div>
-                    <div class="info-value" style="color: #4CAF50;">{uptime_str}</div>
-                </div>
-                <div class="info-item">
-                    <div class="info-label">Downtime</div>
-                    <div class="info-value" style="color: #f44336;">{downtime_str}</div>
-                </div>
-                <div class="info-item">
-                    <div class="info-label">Outages</div>
-                    <div class="info-value">{outages}</div>
-                </div>
-                <div class="info-item">
-                    <div class="info-label">Timezone</div>
-                    <div class="info-value" style="font-size: 16px;">{config["timezone"]}</div>
-                </div>
-            </div>
-        </div>
-        
-        <div class="footer">
-            Auto-refreshes every 30 seconds • Powered by Light Status Bot
-        </div>
-    </body>
-    </html>
-    """
+    html = DASHBOARD_TEMPLATE.substitute(
+        channel_name=channel_name,
+        status=status,
+        status_color=status_color,
+        last_ping_str=last_ping_str,
+        time_since_str=time_since_str,
+        uptime_str=uptime_str,
+        downtime_str=downtime_str,
+        outages=outages,
+        timezone=config["timezone"],
+    )
     
-    return web.Response(text=html, content_type='text/html')
+    return html.encode()
+
+@web.middleware
+async def compression_middleware(request, handler):
+    """Gzip/deflate larger HTTP bodies when the client accepts it"""
+    response = await handler(request)
+    body = getattr(response, 'body', None)
+    if isinstance(body, bytes) and len(body) >= COMPRESS_MIN_BYTES:
+        response.enable_compression()
+    return response
+
+def json_response(data):
+    """JSON response encoded by orjson straight to bytes"""
+    return web.Response(body=orjson.dumps(data), content_type='application/json')
 
 async def handle_api_channels(request):
     """API endpoint for Grafana - list all channels"""
-    conn = sqlite3.connect(DB_FILE)
-    channels = conn.execute(
+    channels = await db.execute_fetchall(
         "SELECT channel_id, channel_name, is_power_on, last_request_time FROM channels WHERE owner_id IS NOT NULL"
-    ).fetchall()
-    conn.close()
+    )
     
     result = []
     for ch_id, ch_name, is_on, last_req in channels:
@@ -1400,37 +1692,78 @@ async def handle_api_channels(request):
             "last_ping": last_req
         })
     
-    return web.json_response(result)
+    return json_response(result)
+
+# (expires_at, {channel_id: channel_name}) for /api/history
+_name_map = (0, {})
+
+async def get_channel_name_map():
+    """Return channel_id -> channel_name, reloaded at most every NAME_MAP_TTL seconds"""
+    global _name_map
+    expires_at, names = _name_map
+    if time.monotonic() >= expires_at:
+        names = dict(await db.execute_fetchall("SELECT channel_id, channel_name FROM channels"))
+        _name_map = (time.monotonic() + NAME_MAP_TTL, names)
+    return names
 
 async def handle_api_history(request):
     """API endpoint for Grafana - status history"""
-    conn = sqlite3.connect(DB_FILE)
-    history = conn.execute("""
-        SELECT h.timestamp, h.channel_id, c.channel_name, h.status 
-        FROM history h 
-        LEFT JOIN channels c ON h.channel_id = c.channel_id 
-        ORDER BY h.timestamp DESC 
-        LIMIT 1000
-    """).fetchall()
-    conn.close()
+    names = await get_channel_name_map()
+    history = await db.execute_fetchall(
+        "SELECT timestamp, channel_id, status FROM history ORDER BY timestamp DESC LIMIT 1000"
+    )
     
     result = []
-    for ts, ch_id, ch_name, status in history:
+    for ts, ch_id, status in history:
         result.append({
             "timestamp": int(ts * 1000),  # milliseconds for Grafana
             "channel_id": ch_id,
-            "channel_name": ch_name or f"Channel {ch_id}",
+            "channel_name": names.get(ch_id) or f"Channel {ch_id}",
             "status": status
         })
     
-    return web.json_response(result)
+    return json_response(result)
+
+# Keeps references to fire-and-forget tasks so they are not garbage collected mid-run
+background_tasks = set()
+
+def spawn(coro):
+    """Run a coroutine in the background"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def send_dm_notifications(channel_id, message):
+    """Send a status message to every user with DM notifications on for the channel"""
+    users = await get_subscribers(channel_id)
+    dm_text = f"🔔 Канал {channel_id}\n\n{message}"
+    
+    async def send(user_id):
+        async with dm_semaphore:
+            await tg_bot.send_message(
+                chat_id=user_id,
+                text=dm_text
+            )
+    
+    results = await asyncio.gather(*(send(user_id) for user_id in users), return_exceptions=True)
+    blocked = []
+    for user_id, result in zip(users, results):
+        if isinstance(result, Forbidden):
+            blocked.append(user_id)
+        elif isinstance(result, Exception):
+            logger.warning("DM to %s for channel %s failed: %s", user_id, channel_id, result)
+    
+    if blocked:
+        await disable_notifications(channel_id, blocked)
+        logger.info("Disabled DM notifications for %d blocked users of channel %s", len(blocked), channel_id)
 
 async def handle_ping(request):
     api_key = request.query.get('channel_key')
     if not api_key:
         return web.Response(text="Missing channel_key parameter", status=400)
     
-    channel = get_channel_by_key(api_key)
+    channel = await get_channel_by_key(api_key)
     if not channel:
         return web.Response(text="Invalid key", status=403)
     
@@ -1440,10 +1773,8 @@ async def handle_ping(request):
     # Update last request time
     update_last_request(api_key, now)
     
-    # If power was off, turn it on and send message
-    if not was_on:
-        update_power_status(api_key, True, now)
-        
+    # If power was off, turn it on and send message (a concurrent ping may have done it already)
+    if not was_on and await update_power_status(api_key, True, now, channel["timezone"]):
         # Calculate how long it was off
         if channel["last_status_change"]:
             duration = now - channel["last_status_change"]
@@ -1452,181 +1783,247 @@ async def handle_ping(request):
             duration_text = "невідомо"
         
         # Send Telegram message
-        tz = pytz.timezone(channel["timezone"])
+        tz = get_tz(channel["timezone"])
         time_str = datetime.fromtimestamp(now, tz).strftime("%H:%M")
         
         message = f"🟢 {time_str} Електрохарчування відновлено\n🕓 Його не було {duration_text}"
         
         # Add daily stats
-        stats = get_daily_stats(channel["channel_id"], channel["timezone"])
+        stats = await get_daily_stats(channel["channel_id"], channel["timezone"])
         if stats:
             uptime_str = format_duration(stats["uptime"])
             downtime_str = format_duration(stats["downtime"])
             message += f"\n\n📊 Сьогодні: {uptime_str} онлайн, {downtime_str} офлайн ({stats['outages']} відключень)"
         
-        if telegram_app:
+        if tg_bot:
             # Send to channel
-            await telegram_app.bot.send_message(
+            await tg_bot.send_message(
                 chat_id=channel["channel_id"],
                 text=message
             )
             
-            # Send DM notifications to users who enabled them
-            conn = sqlite3.connect(DB_FILE)
-            users = conn.execute(
-                "SELECT user_id FROM notifications WHERE channel_id = ? AND enabled = 1",
-                (channel["channel_id"],)
-            ).fetchall()
-            conn.close()
-            
-            for (user_id,) in users:
-                try:
-                    await telegram_app.bot.send_message(
-                        chat_id=user_id,
-                        text=f"🔔 Канал {channel['channel_id']}\n\n{message}"
-                    )
-                except Exception:
-                    pass  # User might have blocked the bot
+            # Send DM notifications to users who enabled them, without holding up the response
+            spawn(send_dm_notifications(channel["channel_id"], message))
     
     return web.Response(text="OK")
 
+# Powered, unpaused channels whose last ping is older than the cutoff (served by idx_channels_active)
+TIMED_OUT_CHANNELS_SQL = (
+    "SELECT channel_id, api_key, timezone, last_request_time, is_power_on, last_status_change FROM channels "
+    "WHERE is_power_on = 1 AND paused = 0 AND last_request_time < ?"
+)
+
 async def check_timeouts():
     """Background task to check for timeouts"""
-    global telegram_app
     await asyncio.sleep(10)  # Wait for bot to initialize
     
     while True:
         await asyncio.sleep(30)  # Check every 30 seconds
         
-        conn = sqlite3.connect(DB_FILE)
-        cur = conn.execute("SELECT channel_id, api_key, timezone, last_request_time, is_power_on, last_status_change FROM channels WHERE is_power_on = 1 AND paused = 0")
-        channels = cur.fetchall()
-        conn.close()
-        
         now = datetime.now().timestamp()
         timeout_seconds = TIMEOUT_MINUTES * 60
+        channels = await db.execute_fetchall(TIMED_OUT_CHANNELS_SQL, (now - timeout_seconds,))
+        if len(channels) > 1:
+            # Several channels went dark together, fetch all their subscribers at once
+            await prime_subscribers([row[0] for row in channels])
         
         for row in channels:
             channel_id, api_key, tz_str, last_req, is_on, last_change = row
             
-            if last_req and (now - last_req) > timeout_seconds:
-                # Power is off - use last_req as the OFF time, not now
-                update_power_status(api_key, False, last_req)
-                
-                # Calculate how long it was on
-                if last_change:
-                    duration = last_req - last_change
-                    duration_text = format_duration(duration)
-                else:
-                    duration_text = "невідомо"
-                
-                # Send Telegram message
-                tz = pytz.timezone(tz_str)
-                time_str = datetime.fromtimestamp(last_req, tz).strftime("%H:%M")
-                
-                message = f"🔴 {time_str} Електрохарчування відсутнє\n🕓 Воно було {duration_text}"
-                
-                # Add daily stats
-                stats = get_daily_stats(channel_id, tz_str)
-                if stats:
-                    uptime_str = format_duration(stats["uptime"])
-                    downtime_str = format_duration(stats["downtime"])
-                    message += f"\n\n📊 Сьогодні: {uptime_str} онлайн, {downtime_str} офлайн ({stats['outages']} відключень)"
-                
-                if telegram_app:
-                    try:
-                        # Send to channel
-                        await telegram_app.bot.send_message(
-                            chat_id=channel_id,
-                            text=message
-                        )
-                        
-                        # Send DM notifications
-                        conn_notify = sqlite3.connect(DB_FILE)
-                        users = conn_notify.execute(
-                            "SELECT user_id FROM notifications WHERE channel_id = ? AND enabled = 1",
-                            (channel_id,)
-                        ).fetchall()
-                        conn_notify.close()
-                        
-                        for (user_id,) in users:
-                            try:
-                                await telegram_app.bot.send_message(
-                                    chat_id=user_id,
-                                    text=f"🔔 Канал {channel_id}\n\n{message}"
-                                )
-                            except Exception:
-                                pass  # User might have blocked the bot
-                    except Exception as e:
-                        print(f"Error sending message to {channel_id}: {e}")
+            # A ping that is still buffered means the device is alive
+            if api_key in pending_pings:
+                continue
+            
+            # Power is off - use last_req as the OFF time, not now. Passing it again
+            # skips the channel if a ping was flushed after the SELECT above.
+            if not await update_power_status(api_key, False, last_req, tz_str, last_req):
+                continue
+            
+            # Calculate how long it was on
+            if last_change:
+                duration = last_req - last_change
+                duration_text = format_duration(duration)
+            else:
+                duration_text = "невідомо"
+            
+            # Send Telegram message
+            tz = get_tz(tz_str)
+            time_str = datetime.fromtimestamp(last_req, tz).strftime("%H:%M")
+            
+            message = f"🔴 {time_str} Електрохарчування відсутнє\n🕓 Воно було {duration_text}"
+            
+            # Add daily stats
+            stats = await get_daily_stats(channel_id, tz_str)
+            if stats:
+                uptime_str = format_duration(stats["uptime"])
+                downtime_str = format_duration(stats["downtime"])
+                message += f"\n\n📊 Сьогодні: {uptime_str} онлайн, {downtime_str} офлайн ({stats['outages']} відключень)"
+            
+            if tg_bot:
+                try:
+                    # Send to channel
+                    await tg_bot.send_message(
+                        chat_id=channel_id,
+                        text=message
+                    )
+                    
+                    # Send DM notifications concurrently without holding up the next channel
+                    spawn(send_dm_notifications(channel_id, message))
+                except Exception:
+                    logger.exception("Error sending message to %s", channel_id)
 
-def main():
-    global telegram_app
-    
-    init_db()
-    
-    # Get bot token
-    import os
-    token = os.getenv("BOT_TOKEN")
-    if not token:
-        try:
-            with open("token.txt") as f:
-                token = f.read().strip()
-        except FileNotFoundError:
-            print("ERROR: BOT_TOKEN environment variable not set and token.txt not found")
-            return
+async def prune_history():
+    """Background task to delete old history, shrink the database file and refresh planner stats"""
+    while True:
+        cutoff = datetime.now().timestamp() - HISTORY_RETENTION_DAYS * 24 * 3600
+        # executescript() commits any open transaction first, so nothing else may be mid-write
+        async with db_lock:
+            cur = await db.execute("DELETE FROM history WHERE timestamp < ?", (cutoff,))
+            deleted = cur.rowcount
+            # executescript steps the pragma to completion, execute() frees a single page
+            await db.executescript("PRAGMA incremental_vacuum(1000);")
+            await optimize_db()
+        if deleted:
+            logger.info("Pruned %d history rows older than %d days", deleted, HISTORY_RETENTION_DAYS)
+        
+        await asyncio.sleep(24 * 3600)  # Once a day
+
+# Bot commands: /name -> handler
+COMMANDS = {
+    "start": start,
+    "create_channel": create_channel_cmd,
+    "import_channel": import_channel_cmd,
+    "get_key": get_key_cmd,
+    "list_keys": list_keys_cmd,
+    "set_timezone": set_timezone_cmd,
+    "regenerate_key": regenerate_key_cmd,
+    "replace_key": replace_key_cmd,
+    "remove_channel": remove_channel_cmd,
+    "transfer": transfer_cmd,
+    "history": history_cmd,
+    "notify": notify_cmd,
+    "pause": pause_cmd,
+    "stop": stop_cmd,
+    "resume": resume_cmd,
+    "export": export_cmd,
+    "status": status_cmd,
+    "whitelist_add": whitelist_add_cmd,
+    "whitelist_remove": whitelist_remove_cmd,
+    "whitelist_list": whitelist_list_cmd,
+}
+
+async def handle_telegram_webhook(request):
+    """Receive Telegram updates pushed to WEBHOOK_PATH"""
+    # Constant-time compare so response timing does not leak the secret; bytes, since
+    # compare_digest rejects non-ASCII str and a forged header may contain anything
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode(errors="replace")
+    if not hmac.compare_digest(token, webhook_secret.encode()):
+        return web.Response(status=403)
+    update = Update.de_json(await request.json(loads=orjson.loads), tg_bot)
+    await telegram_app.update_queue.put(update)
+    return web.Response()
+
+async def amain(token):
+    """Run the bot, HTTP server and background tasks on one event loop"""
+    global telegram_app, tg_bot
     
     # Create Telegram bot
-    global telegram_app
-    telegram_app = Application.builder().token(token).build()
-    
-    telegram_app.add_handler(CommandHandler("start", start))
-    telegram_app.add_handler(CommandHandler("create_channel", create_channel_cmd))
-    telegram_app.add_handler(CommandHandler("import_channel", import_channel_cmd))
-    telegram_app.add_handler(CommandHandler("get_key", get_key_cmd))
-    telegram_app.add_handler(CommandHandler("list_keys", list_keys_cmd))
-    telegram_app.add_handler(CommandHandler("set_timezone", set_timezone_cmd))
-    telegram_app.add_handler(CommandHandler("regenerate_key", regenerate_key_cmd))
-    telegram_app.add_handler(CommandHandler("replace_key", replace_key_cmd))
-    telegram_app.add_handler(CommandHandler("remove_channel", remove_channel_cmd))
-    telegram_app.add_handler(CommandHandler("transfer", transfer_cmd))
-    telegram_app.add_handler(CommandHandler("history", history_cmd))
-    telegram_app.add_handler(CommandHandler("notify", notify_cmd))
-    telegram_app.add_handler(CommandHandler("pause", pause_cmd))
-    telegram_app.add_handler(CommandHandler("stop", stop_cmd))
-    telegram_app.add_handler(CommandHandler("resume", resume_cmd))
-    telegram_app.add_handler(CommandHandler("export", export_cmd))
-    telegram_app.add_handler(CommandHandler("status", status_cmd))
-    telegram_app.add_handler(CommandHandler("whitelist_add", whitelist_add_cmd))
-    telegram_app.add_handler(CommandHandler("whitelist_remove", whitelist_remove_cmd))
-    telegram_app.add_handler(CommandHandler("whitelist_list", whitelist_list_cmd))
-    telegram_app.add_handler(MessageHandler(filters.FORWARDED & filters.ChatType.PRIVATE, handle_forwarded))
-    telegram_app.add_handler(ChatMemberHandler(handle_my_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
-    
-    # Start HTTP server
-    app = web.Application()
+    # Paces sends to Telegram's flood limits (30 msg/s overall) and retries after RetryAfter.
+    # HTTP/2 multiplexes concurrent sends (e.g. a DM fan-out) over one TLS connection.
+    telegram_app = (
+        Application.builder()
+        .token(token)
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        .http_version("2")
+        .build()
+    )
+    tg_bot = telegram_app.bot
+    
+    telegram_app.add_handlers(
+        [CommandHandler(name, callback) for name, callback in COMMANDS.items()]
+        + [
+            MessageHandler(filters.FORWARDED & filters.ChatType.PRIVATE, handle_forwarded),
+            ChatMemberHandler(handle_my_chat_member, ChatMemberHandler.MY_CHAT_MEMBER),
+        ]
+    )
+    
+    # HTTP server
+    app = web.Application(middlewares=[compression_middleware])
     app.router.add_get('/api/channels', handle_api_channels)
     app.router.add_get('/api/history', handle_api_history)
     app.router.add_get('/status/@{username}', handle_dashboard)
     app.router.add_get('/status/{channel_id}', handle_dashboard)
     app.router.add_get('/channelPing', handle_ping)
+    if WEBHOOK_URL:
+        app.router.add_post(WEBHOOK_PATH, handle_telegram_webhook)
+    
+    runner = web.AppRunner(app)
+    loops = []
     
-    # Start HTTP and timeout checker in background
-    async def start_background():
-        # Start HTTP server
-        runner = web.AppRunner(app)
+    # Startup is inside the try too: the database thread is not a daemon, so a failed
+    # start (e.g. the port is taken) must still close it or the process never exits
+    try:
+        await init_db()
+        
         await runner.setup()
         site = web.TCPSite(runner, '0.0.0.0', HTTP_PORT)
         await site.start()
-        print(f"HTTP server started on port {HTTP_PORT}")
+        logger.info("HTTP server started on port %d", HTTP_PORT)
+        
+        # Start buffered writer, timeout checker and history cleanup
+        loops = [
+            asyncio.create_task(pending_writer()),
+            asyncio.create_task(check_timeouts()),
+            asyncio.create_task(prune_history()),
+        ]
+        
+        # Stop cleanly on Ctrl+C and on systemd's SIGTERM
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
         
-        # Start timeout checker
-        asyncio.create_task(check_timeouts())
+        async with telegram_app:
+            await telegram_app.start()
+            if WEBHOOK_URL:
+                await tg_bot.set_webhook(url=WEBHOOK_URL + WEBHOOK_PATH, secret_token=webhook_secret)
+                logger.info("Receiving Telegram updates via webhook at %s%s", WEBHOOK_URL, WEBHOOK_PATH)
+            else:
+                await telegram_app.updater.start_polling()
+                logger.info("Starting Telegram bot...")
+            
+            await stop.wait()
+            
+            # Stop taking pings and checking timeouts first, so no status change is
+            # committed after the bot can no longer announce it (close_db flushes the rest)
+            await runner.cleanup()
+            for task in loops:
+                task.cancel()
+            await asyncio.gather(*loops, return_exceptions=True)
+            # Let notifications already being sent go out before the bot's HTTP client closes
+            if background_tasks:
+                await asyncio.wait(background_tasks, timeout=SHUTDOWN_DRAIN_TIMEOUT)
+            if telegram_app.updater.running:
+                await telegram_app.updater.stop()
+            await telegram_app.stop()
+    finally:
+        await runner.cleanup()
+        for task in loops:
+            task.cancel()
+        await asyncio.gather(*loops, return_exceptions=True)
+        await close_db()
+
+def main():
+    setup_logging()
     
-    telegram_app.post_init = lambda app: start_background()
+    # Get bot token, token.txt is only consulted when BOT_TOKEN is not set
+    token_file = Path("token.txt")
+    token = os.getenv("BOT_TOKEN") or (token_file.read_text().strip() if token_file.exists() else None)
+    if not token:
+        logger.error("BOT_TOKEN environment variable not set and token.txt not found")
+        return
     
-    print("Starting Telegram bot...")
-    telegram_app.run_polling()
+    asyncio.run(amain(token))
 
 if __name__ == "__main__":
     main()